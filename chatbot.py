@@ -1,35 +1,192 @@
+# heavyweight modules (wikipedia, ollama, langfuse, symspellpy, httpx, dotenv) are
+# imported on first use to keep startup and idle worker memory small
 import re
-import wikipedia
-import ollama
-from spellchecker import SpellChecker
-from langfuse import Langfuse
-from dotenv import load_dotenv
+import atexit
+import asyncio
+import difflib
+import requests
+from requests.adapters import HTTPAdapter
 import os
+import time
+import functools
+import threading
+from importlib import resources
 import traceback
-
-load_dotenv()
-wikipedia.set_lang("en")
+from cachetools import TTLCache
+
+# one keep-alive session for the (synchronous) wikipedia package
+_sess = requests.Session()
+_sess.headers.update({"User-Agent": "WikiChatbot/1.0"})
+_sess.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+WIKI_API_URL = "https://en.wikipedia.org/w/api.php"
+
+# search results and page content barely change; keep them for an hour so
+# repeated questions skip the Wikipedia round trips entirely
+_search_cache = TTLCache(maxsize=1024, ttl=3600)
+_page_cache = TTLCache(maxsize=1024, ttl=3600)
+_cache_lock = threading.Lock()
+
+# question words stripped before picking the topic
+_STOP = frozenset(
+    "what who why where when how explain define describe tell me about "
+    "characteristics features types information info about of".split()
+)
+_WORD_RE = re.compile(r"[A-Za-z]+")
+
+# markdown emphasis and quotes around the title in a ranker reply; apostrophes
+# inside words ("Ender's Game") are kept
+_REPLY_NOISE_RE = re.compile(r"[*`\"“”‘’]|(?<!\w)'|'(?!\w)")
+
+# stream_llm groups tokens into one chunk per ~20 ms / 32 chars
+_FLUSH_CHARS = 32
+_FLUSH_SECONDS = 0.02
+
+# keep the model resident between requests instead of Ollama's 5 min default
+KEEP_ALIVE = "30m"
+
+# load-time options must be identical on every call: a different num_ctx makes
+# Ollama reload the model. 4096 fits the trimmed page content plus the answer.
+_MODEL_OPTIONS = {"num_ctx": 4096}
+
+# trailing sections that only pad the answer prompt
+_TAIL_SECTIONS_RE = re.compile(r"\n==+ (References|External links|See also|Further reading) ==+\n")
+
+def _truncate(txt, max_chars=4000):
+    # cut at the last sentence end so the prompt never ends mid-sentence
+    if len(txt) <= max_chars:
+        return txt
+    cut = txt.rfind(". ", 0, max_chars)
+    return txt[:cut + 1] if cut > 0 else txt[:max_chars]
+
+@functools.lru_cache(maxsize=None)
+def _http():
+    import httpx
+
+    # async HTTP/2 client for direct MediaWiki API calls: concurrent requests
+    # are multiplexed over a single TLS connection
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=20,
+        headers={"User-Agent": "WikiChatbot/1.0"},
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+
+async def _wiki_get(params):
+    resp = await _http().get(WIKI_API_URL, params={"format": "json", **params})
+    resp.raise_for_status()
+    return resp.json()
+
+async def _wiki_search(query, results=10):
+    # same list=search query as wikipedia.search(), minus the library's unbounded
+    # @cache, so _search_cache's TTL and size limit actually apply
+    data = await _wiki_get({
+        "action": "query",
+        "list": "search",
+        "srprop": "",
+        "srlimit": results,
+        "srsearch": query,
+    })
+    if "error" in data:
+        raise RuntimeError(data["error"].get("info", "Wikipedia search failed"))
+    return [d["title"] for d in data["query"]["search"]]
+
+@functools.lru_cache(maxsize=None)
+def _wikipedia():
+    import wikipedia
+
+    wikipedia.set_lang("en")
+    # the wikipedia package calls requests.get() for every API hit, opening a new
+    # TCP+TLS connection each time; route it through one keep-alive session instead
+    wikipedia.set_user_agent("WikiChatbot/1.0")
+    wikipedia.wikipedia.requests = _sess
+    # the library defaults to http://, which costs a redirect on every call
+    wikipedia.wikipedia.API_URL = WIKI_API_URL
+    return wikipedia
+
+@functools.lru_cache(maxsize=None)
+def _symspell():
+    from symspellpy import SymSpell
+
+    # symmetric-delete index: correction is a dict lookup, not edit enumeration
+    sym = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
+    dictionary = resources.files("symspellpy") / "frequency_dictionary_en_82_765.txt"
+    sym.load_dictionary(str(dictionary), term_index=0, count_index=1)
+    return sym
+
+def preload():
+    # build the process-wide resources now, e.g. before a pre-forking server
+    # forks its workers so they share them copy-on-write
+    _wikipedia()
+    _symspell()
+
+async def aclose():
+    # close the pooled MediaWiki connections; the client is bound to the running
+    # event loop, so drop it from the cache and let the next use build a new one
+    if _http.cache_info().currsize:
+        await _http().aclose()
+    _http.cache_clear()
 
 class WikiChatbot:
+    # static instructions go in the system message so Ollama can reuse its KV cache
+    _SYSTEM = (
+        "Use the following content to answer. Format:\n"
+        "- Definition\n"
+        "- Background\n"
+        "- Important Details\n"
+        "- Notes"
+    )
+
     def __init__(self, model="gemma3:1b"):
+        import ollama
+        from dotenv import load_dotenv
+        from langfuse import Langfuse
+
+        load_dotenv()
         self.model = model
-        self.ollama = ollama.Client()
-        self.spell = SpellChecker()
-        self.lf = Langfuse()  # uses env variables
+        self.ollama = ollama.AsyncClient()
+        # uses env variables; events are queued and sent in batches by background threads
+        self.lf = Langfuse(flush_at=50, flush_interval=2.0, threads=2)
+        atexit.register(self.lf.flush)
+        self._background = set()
         print(f"✓ Chatbot initialized with model: {model}")
 
+    # -----------------------------------------------------
+    def _spawn(self, coro):
+        # the event loop only keeps weak references to tasks; hold them until done
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    # -----------------------------------------------------
+    async def warmup(self):
+        # one-token request that loads the weights and resets the keep-alive timer
+        await self.ollama.chat(
+            model=self.model,
+            messages=[{"role": "user", "content": "ok"}],
+            options={**_MODEL_OPTIONS, "num_predict": 1},
+            keep_alive=KEEP_ALIVE,
+        )
+
+    # -----------------------------------------------------
+    @staticmethod
+    def _correct(word):
+        from symspellpy import Verbosity
+
+        suggestions = _symspell().lookup(word, Verbosity.TOP, max_edit_distance=2)
+        return suggestions[0].term if suggestions else word
+
     # -----------------------------------------------------
     def extract_topic(self, question, parent_trace=None):
         trace = self.lf.trace(name="extract_topic", input={"question": question})
         try:
-            q = question.lower()
-            remove_words = (
-                "what who why where when how explain define describe tell me about "
-                "characteristics features types information info about of"
-            ).split()
-
-            words = [w for w in re.findall(r"[a-zA-Z]+", q) if w not in remove_words]
-            topic = self.spell.correction(words[-1]) if words else question
+            words = [w for w in _WORD_RE.findall(question.lower()) if w not in _STOP]
+            if words:
+                # only look up corrections for unknown words
+                last = words[-1]
+                topic = last if last in _symspell().words else self._correct(last)
+            else:
+                topic = question
 
             trace.output = {"topic": topic}
             return topic
@@ -40,15 +197,25 @@ class WikiChatbot:
             # trace.end()
 
     # -----------------------------------------------------
-    def search(self, question, topic):
+    async def search(self, question, topic):
         trace = self.lf.trace(name="wikipedia_search", input={"question": question, "topic": topic})
+        key = question.lower().strip()
         try:
+            with _cache_lock:
+                cached = _search_cache.get(key)
+            if cached is not None:
+                trace.output = {"results": cached, "cached": True}
+                return cached
+
             try:
-                r = wikipedia.search(question)
+                r = await _wiki_search(question)
                 if not r:
-                    r = wikipedia.search(topic)
+                    r = await _wiki_search(topic)
             except Exception:
                 r = []
+            if r:
+                with _cache_lock:
+                    _search_cache[key] = r
             trace.output = {"results": r}
             return r
         except Exception as e:
@@ -58,19 +225,111 @@ class WikiChatbot:
             # trace.end()
 
     # -----------------------------------------------------
-    def rank_pages(self, question, results):
+    async def _batch_summaries(self, titles):
+        # one MediaWiki extracts query for all titles instead of 2 requests per page
+        data = await _wiki_get({
+            "action": "query",
+            "prop": "extracts",
+            "exintro": 1,
+            "explaintext": 1,
+            "redirects": 1,
+            "exlimit": len(titles),
+            "titles": "|".join(titles),
+        })
+        query = data["query"]
+
+        # map requested titles through normalization/redirects to the returned ones
+        aliases = {}
+        for entry in query.get("normalized", []) + query.get("redirects", []):
+            aliases[entry["from"]] = entry["to"]
+
+        extracts = {p["title"]: p.get("extract", "")[:300] for p in query.get("pages", {}).values()}
+
+        summaries = {}
+        for title in titles:
+            # normalization first, then a redirect at most
+            resolved = aliases.get(title, title)
+            resolved = aliases.get(resolved, resolved)
+            summaries[title] = extracts.get(resolved) or "Unable to load summary."
+        return summaries
+
+    # -----------------------------------------------------
+    async def _summary_only(self, title):
+        # lead extract only: one request instead of wikipedia.page() + .summary
+        try:
+            data = await _wiki_get({
+                "action": "query",
+                "prop": "extracts",
+                "exintro": 1,
+                "explaintext": 1,
+                "redirects": 1,
+                "titles": title,
+            })
+            page = next(iter(data["query"]["pages"].values()))
+            return page.get("extract", "")[:300] or "Unable to load summary."
+        except Exception:
+            return "Unable to load summary."
+
+    # -----------------------------------------------------
+    @staticmethod
+    def _obvious_match(question, results, topic=None):
+        if len(results) == 1:
+            return True
+        top = results[0].lower()
+        if topic and top.replace(" ", "") == topic.lower().replace(" ", ""):
+            return True
+        return difflib.SequenceMatcher(None, top, question.lower()).ratio() > 0.8
+
+    # -----------------------------------------------------
+    @staticmethod
+    def _match_title(selected, titles):
+        # small models wrap the title in prose ("The best page is ..."); map the
+        # reply back onto a real candidate so get_page doesn't miss
+        reply = selected.lower()
+        bare = _REPLY_NOISE_RE.sub("", reply).strip(" .")
+
+        # a candidate named verbatim in the reply wins; prefer the longest so
+        # "Python (programming language)" beats "Python"
+        named = [
+            t for t in titles
+            if any(re.search(rf"(?<!\w){re.escape(t.lower())}(?!\w)", r) for r in (reply, bare))
+        ]
+        if named:
+            return max(named, key=len)
+
+        def score(t):
+            return difflib.SequenceMatcher(None, t.lower(), bare).ratio()
+
+        best = max(titles, key=score)
+        return best if score(best) >= 0.5 else titles[0]
+
+    # -----------------------------------------------------
+    async def rank_pages(self, question, results, topic=None):
         trace = self.lf.trace(name="rank_pages", input={"question": question, "results": results})
         span = None
         try:
-            snippets = []
-            for title in results[:5]:
-                try:
-                    page = wikipedia.page(title, auto_suggest=False)
-                    snippet = page.summary[:300]
-                except Exception:
-                    snippet = "Unable to load summary."
+            # skip the LLM when the top hit is already unambiguous
+            if self._obvious_match(question, results, topic):
+                trace.output = {"best_page": results[0], "shortcut": True}
+                return results[0]
 
-                snippets.append(f"### {title}\n{snippet}")
+            import httpx
+
+            titles = results[:5]
+            try:
+                summaries = await self._batch_summaries(titles)
+            except (httpx.TransportError, httpx.HTTPStatusError):
+                # timeout, connection error or 5xx: retrying the same host per title
+                # would only double the wait, so rank without summaries
+                summaries = {}
+            except (ValueError, KeyError, TypeError):
+                # malformed batch response (bad JSON, missing "query"); ask for each
+                # title on its own, still concurrent
+                fetched = await asyncio.gather(*[self._summary_only(t) for t in titles])
+                summaries = dict(zip(titles, fetched))
+            except Exception:
+                summaries = {}
+            snippets = [f"### {t}\n{summaries.get(t, 'Unable to load summary.')}" for t in titles]
 
             combined = "\n\n".join(snippets)
 
@@ -87,17 +346,20 @@ Return ONLY the page title.
 
             # create an explicit span for the LLM rank call (linked to the trace)
             span = self.lf.span(trace_id=trace.id, name="ollama_rank_call", input={"prompt": prompt})
-            resp = self.ollama.chat(
+            resp = await self.ollama.chat(
                 model=self.model,
                 messages=[{"role": "user", "content": prompt}],
+                options={**_MODEL_OPTIONS, "num_predict": 24, "temperature": 0},
+                keep_alive=KEEP_ALIVE,
             )
             selected = resp["message"]["content"].strip()
+            best = self._match_title(selected, titles)
 
             span.output = {"selected": selected}
             span.end()
 
-            trace.output = {"best_page": selected}
-            return selected
+            trace.output = {"best_page": best}
+            return best
         except Exception as e:
             if span:
                 try:
@@ -111,17 +373,29 @@ Return ONLY the page title.
         #     trace.end()
 
     # -----------------------------------------------------
-    def get_page(self, title):
+    async def get_page(self, title):
         trace = self.lf.trace(name="fetch_page", input={"title": title})
+        # MediaWiki titles are case-sensitive after the first character
+        key = title.strip().replace("_", " ")
+        key = key[:1].upper() + key[1:]
         try:
+            with _cache_lock:
+                cached = _page_cache.get(key)
+            if cached is not None:
+                trace.output = {"content_found": True, "cached": True}
+                return cached
+
             try:
-                page = wikipedia.page(title, auto_suggest=True)
-                content = page.content
-                if len(content) > 6000:
-                    content = content[:6000] + "..."
+                page = await asyncio.to_thread(_wikipedia().page, title, auto_suggest=True)
+                content = await asyncio.to_thread(lambda: page.content)
+                content = _TAIL_SECTIONS_RE.split(content, maxsplit=1)[0]
+                content = _truncate(content)
             except Exception:
                 content = None
 
+            if content:
+                with _cache_lock:
+                    _page_cache[key] = content
             trace.output = {"content_found": bool(content)}
             return content
         except Exception as e:
@@ -131,7 +405,7 @@ Return ONLY the page title.
         #     trace.end()
 
     # -----------------------------------------------------
-    def stream_llm(self, prompt, parent_trace_id=None):
+    async def stream_llm(self, prompt, parent_trace_id=None, system=None):
         # create a span specifically for the streaming LLM call (linked to parent trace)
         span = None
         trace = None
@@ -143,15 +417,26 @@ Return ONLY the page title.
                 trace = self.lf.trace(name="final_answer_generation", input={"prompt": prompt})
                 span = self.lf.span(trace_id=trace.id, name="ollama_stream_call", input={"prompt": prompt})
 
-            # synchronous streaming from ollama; yield tokens to caller
-            for chunk in self.ollama.chat(
+            # async streaming from ollama; batch tokens in a tumbling window so
+            # the caller emits one frame per window instead of one per sub-word
+            messages = [{"role": "user", "content": prompt}]
+            if system:
+                messages.insert(0, {"role": "system", "content": system})
+
+            buf, last = "", time.monotonic()
+            async for chunk in await self.ollama.chat(
                 model=self.model,
-                messages=[{"role": "user", "content": prompt}],
+                messages=messages,
                 stream=True,
+                options={**_MODEL_OPTIONS, "num_predict": 512, "temperature": 0.3},
+                keep_alive=KEEP_ALIVE,
             ):
-                token = chunk["message"]["content"]
-                # we can emit partial token info in span output if desired (lightweight)
-                yield token
+                buf += chunk["message"]["content"]
+                if len(buf) >= _FLUSH_CHARS or time.monotonic() - last >= _FLUSH_SECONDS:
+                    yield buf
+                    buf, last = "", time.monotonic()
+            if buf:
+                yield buf
 
             span.output = {"status": "completed"}
             span.end()
@@ -175,7 +460,7 @@ Return ONLY the page title.
             raise
 
     # -----------------------------------------------------
-    def answer_stream(self, question):
+    async def answer_stream(self, question):
         outer = self.lf.trace(name="answer_pipeline", input={"question": question})
         final_answer = ""   # ⬅ WE WILL STORE FULL ANSWER HERE
 
@@ -192,7 +477,7 @@ Return ONLY the page title.
 
             # search
             try:
-                results = self.search(question, topic)
+                results = await self.search(question, topic)
                 if not results:
                     msg = f"No Wikipedia pages found for '{topic}'."
                     outer.output = {"error": msg}
@@ -206,9 +491,15 @@ Return ONLY the page title.
                 yield msg
                 return
 
+            # speculatively fetch the top candidates while the ranker LLM runs; an
+            # obvious top hit skips the LLM, so there is nothing to overlap with
+            prefetch = {}
+            if not self._obvious_match(question, results, topic):
+                prefetch = {t: self._spawn(self.get_page(t)) for t in results[:3]}
+
             # rank pages
             try:
-                best = self.rank_pages(question, results)
+                best = await self.rank_pages(question, results, topic)
             except Exception as e:
                 msg = f"Error selecting page: {str(e)}"
                 outer.output = {"error": msg}
@@ -216,9 +507,12 @@ Return ONLY the page title.
                 yield msg
                 return
 
-            # fetch page
+            # fetch page (reuse the prefetched one when the ranker picked a candidate);
+            # the other prefetches are left to finish and fill _page_cache, since
+            # cancelling can't stop a fetch already running in a worker thread
+            task = prefetch.get(best)
             try:
-                content = self.get_page(best)
+                content = await task if task else await self.get_page(best)
                 if not content:
                     msg = f"Could not fetch page '{best}'."
                     outer.output = {"error": msg}
@@ -232,24 +526,14 @@ Return ONLY the page title.
                 yield msg
                 return
 
-            # prepare final prompt
-            prompt = f"""
-    Use the following content to answer:
-
-    {content}
-
-    Format:
-    - Definition
-    - Background
-    - Important Details
-    - Notes
-    """
+            # prepare final prompt (instructions live in self._SYSTEM)
+            prompt = f"Question: {question}\n\n{content}"
 
             # ────────────────────────────────────────────────
             # STREAM FINAL LLM RESPONSE
             # ────────────────────────────────────────────────
             try:
-                for token in self.stream_llm(prompt, parent_trace_id=outer.id):
+                async for token in self.stream_llm(prompt, parent_trace_id=outer.id, system=self._SYSTEM):
                     final_answer += token       # ⬅ APPEND TOKEN
                     yield token                 # ⬅ RETURN TOKEN TO FRONTEND
             except Exception as e:
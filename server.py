@@ -1,10 +1,54 @@
 # server.py
+# Ollama serves one request at a time by default; start it with e.g.
+# OLLAMA_NUM_PARALLEL=4 so concurrent /chat requests are actually overlapped.
+# For several workers, preload the app so shared data is built once pre-fork:
+#   CHATBOT_PRELOAD=1 gunicorn server:app -k uvicorn.workers.UvicornWorker --workers 4 --preload
+# Without CHATBOT_PRELOAD, each worker builds them at startup, off the event loop.
+import os
+import asyncio
+import orjson
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from chatbot import WikiChatbot
+from chatbot import WikiChatbot, preload, aclose
 
-app = FastAPI(title="Wikipedia + Ollama Chatbot (sync with Langfuse)")
+# only worth it when pre-forking: build the shared read-only data (wikipedia
+# module, SymSpell index) once so workers inherit it copy-on-write
+if os.getenv("CHATBOT_PRELOAD") == "1":
+    preload()
+
+# one chatbot per worker, created after fork: Langfuse's flush threads and the
+# Ollama client's connections don't survive fork()
+bot = None
+
+WARMUP_INTERVAL = 4 * 60  # seconds between keep-warm pings
+
+
+async def keep_warm():
+    while True:
+        try:
+            await bot.warmup()
+        except Exception as e:
+            print(f"Ollama warmup failed: {e}")
+        await asyncio.sleep(WARMUP_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global bot
+    # extract_topic needs the SymSpell index on every request and runs on the
+    # event loop; build it in a thread before serving (a no-op if preloaded)
+    await asyncio.to_thread(preload)
+    bot = WikiChatbot()
+    # preload the model weights so the first user request doesn't pay for them
+    task = asyncio.create_task(keep_warm())
+    yield
+    task.cancel()
+    await aclose()
+
+
+app = FastAPI(title="Wikipedia + Ollama Chatbot (async with Langfuse)", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -13,9 +57,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# instantiate chatbot once (will initialize Langfuse & Ollama)
-bot = WikiChatbot()
-
 @app.post("/chat")
 async def chat(request: Request):
     payload = await request.json()
@@ -23,13 +64,21 @@ async def chat(request: Request):
     if not question:
         return {"error": "question required"}
 
-    # answer_stream is a generator that yields tokens (synchronous generator)
-    def stream():
-        for token in bot.answer_stream(question):
-            # token might be bytes or str; ensure bytes
-            if isinstance(token, str):
-                yield token.encode("utf-8")
-            else:
-                yield token
+    # answer_stream is an async generator of str tokens; Starlette iterates this
+    # async generator on the event loop itself (a sync one would be driven from
+    # a threadpool). Each token is framed as a server-sent event so browsers
+    # and proxies flush it immediately.
+    async def stream():
+        async for token in bot.answer_stream(question):
+            yield b"data: " + orjson.dumps({"t": token}) + b"\n\n"
+        yield b"data: [DONE]\n\n"
 
-    return StreamingResponse(stream(), media_type="text/plain")
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection": "keep-alive",
+        },
+    )